@@ -1,28 +1,37 @@
 #!/usr/bin/env python3
-import base64
+from gevent import monkey
+monkey.patch_all()
 import os
-import io
+import hashlib
+import tempfile
 import re
+import gevent
 import sqlite3
 import json
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from lxml import etree as ET
 from datetime import datetime
-from collections import deque
-from urllib.parse import quote_plus, unquote_plus
+from collections import OrderedDict
+from urllib.parse import unquote_plus
 from flask import Flask, request, redirect, url_for, flash, Response, g, make_response, send_file, abort
 from pprint import pprint
-from gevent.wsgi import WSGIServer
+from gevent.lock import BoundedSemaphore
+from gevent.pywsgi import WSGIServer
 
 
 app = Flask(__name__)
 
 ###### Configuration Begin ######
 
-app.config['DEBUG'] = True
+app.config['DEBUG'] = False
 WEB_PORT = 21958
 WEBROOT = 'http://127.0.0.1:{}'.format(WEB_PORT)
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache.db')
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+MEMORY_CACHE_SIZE = 1024
+PREFETCH_CONCURRENCY = 8
+HTTP_TIMEOUT = 15  # seconds, for every request made to Douban
 
 ###### Configuration  End  ######
 
@@ -34,80 +43,150 @@ CLEAR_SUFFIX = [
     'dd5.1', 'dts', 'ddp5.1', 'avc',
     'x264', 'x.264', 'h264', 'h.264',
 ]
-REGEX_SEASON_EPISODE = re.compile('\.s([0-9]+)(e([0-9]+))?')
-DIGITS_TO_CHINESE_NUMBER = list(sum(map(lambda s: [s], '零一二三四五六七八九十'), [])) + list(map(lambda s: '十'+s, '一二三四五六七八九'))
-CHINESE_NUMBER_TO_DIGITS = dict(zip(DIGITS_TO_CHINESE_NUMBER, map(str, range(len(DIGITS_TO_CHINESE_NUMBER)))))
+# The title ends at the first season/episode marker or release suffix, whichever comes first
+REGEX_TITLE_END = re.compile(
+    '(?P<season_episode>\\.s(?P<season>[0-9]+)(e(?P<episode>[0-9]+))?)|(?P<suffix>' +
+    '|'.join(map(re.escape, CLEAR_SUFFIX)) + ')')
+DIGITS_TO_CHINESE_NUMBER = tuple('零一二三四五六七八九十') + tuple('十'+s for s in '一二三四五六七八九')
+CHINESE_NUMBER_TO_DIGITS = {chinese: str(digit) for digit, chinese in enumerate(DIGITS_TO_CHINESE_NUMBER)}
+CHINESE_SEASON_TO_DIGITS = {'第{}季'.format(chinese): '第{:02d}季'.format(digit) for digit, chinese in enumerate(DIGITS_TO_CHINESE_NUMBER)}
+REGEX_CHINESE_SEASON = re.compile('|'.join(map(re.escape, CHINESE_SEASON_TO_DIGITS)))
+
+# Shared session so that repeated calls to Douban reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+SESSION.headers['User-Agent'] = 'kodi-douban-scraper-2in1'
+
+
+def init_db():
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # page_size only takes effect on a new database, before it is switched to WAL
+    conn.execute('PRAGMA page_size=8192')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript('''
+    CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS stats (
+        key TEXT PRIMARY KEY,
+        value INT NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS image_url (
+        hash TEXT PRIMARY KEY,
+        url TEXT NOT NULL
+    ) WITHOUT ROWID;
+    INSERT OR IGNORE INTO stats (key, value) VALUES ('num_query', 0), ('num_hit', 0);
+    ''')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# One connection shared by all requests. gevent runs every greenlet on a single OS thread
+# and sqlite calls never yield, so statements of different requests cannot interleave.
+_db = init_db()
 
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        conn = sqlite3.connect(DB_PATH)
-        conn.executescript('''
-        CREATE TABLE IF NOT EXISTS cache (
-            key TEXT UNIQUE,
-            value TEXT NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS stats (
-            key TEXT UNIQUE,
-            value INT NOT NULL
-        );
-        ''')
-        conn.row_factory = sqlite3.Row
-        db = g._database = conn
-    return db
+    return _db
 
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+def incr_stats(key):
+    stats = g.setdefault('stats', {})
+    stats[key] = stats.get(key, 0) + 1
 
 
-def cache_get(key, func, type='json'):
-    assert type in ['json', 'bytes']
+@app.teardown_appcontext
+def flush_stats(exception):
+    stats = g.pop('stats', None)
+    if stats:
+        db = get_db()
+        with db:
+            db.executemany('UPDATE stats SET value=value+? WHERE key=?', [(v, k) for k, v in stats.items()])
+
+
+# In-process LRU of parsed values on top of SQLite, keyed by (key, type).
+# Image paths are not kept here so that a removed file is noticed on the next lookup.
+_memory_cache = OrderedDict()
+
+def memory_cache_put(key, value):
+    _memory_cache[key] = value
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+
+def cache_get(key, func, type='json', stats=True):
+    assert type in ['json', 'file']
+    if stats:
+        incr_stats('num_query')
+    if (key, type) in _memory_cache:
+        _memory_cache.move_to_end((key, type))
+        if stats:
+            incr_stats('num_hit')
+        return _memory_cache[(key, type)]
     db = get_db()
-    cur = db.cursor()
-    cur.execute('SELECT value FROM cache WHERE key=?', (key, ))
-    row = cur.fetchone()
-    cur.execute('UPDATE stats SET value=value+1 WHERE key=?', ('num_query', ))
+    row = db.execute('SELECT value FROM cache WHERE key=?', (key, )).fetchone()
+    if row and type == 'file' and not os.path.exists(os.path.join(IMAGE_DIR, row['value'])):
+        row = None
     if row:
-        cur.execute('UPDATE stats SET value=value+1 WHERE key=?', ('num_hit', ))
-        db.commit()
+        if stats:
+            incr_stats('num_hit')
         if type == 'json':
-            return json.loads(row['value'])
-        elif type == 'bytes':
-            return base64.decodebytes(bytes(row['value'], 'utf-8'))
+            value = json.loads(row['value'])
+        elif type == 'file':
+            return os.path.join(IMAGE_DIR, row['value'])
         elif type == 'str':
-            return row['value']
+            value = row['value']
         else:
             assert False
+        memory_cache_put((key, type), value)
+        return value
     else:
+        # Fetch outside of the transaction so the database is not locked during network I/O
         r = func()
         if type == 'json':
             value = r.json()
-            value_str = json.dumps(value, indent=2)
-        elif type == 'bytes':
-            value = r.content
-            value_str = str(base64.encodebytes(value), 'ascii')
+            value_str = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        elif type == 'file':
+            # Files are named by content hash, and only the name is stored in the database
+            value_str = hashlib.sha1(r.content).hexdigest()
+            value = os.path.join(IMAGE_DIR, value_str)
+            if not os.path.exists(value):
+                with tempfile.NamedTemporaryFile(dir=IMAGE_DIR, delete=False) as f:
+                    f.write(r.content)
+                os.replace(f.name, value)
         elif type == 'str':
             value = r.text
             value_str = r.text
         else:
             assert False
-        cur.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, value_str))
-        db.commit()
+        with db:
+            db.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, value_str))
+        if type in ['json', 'str']:
+            memory_cache_put((key, type), value)
         return value
 
 
+def register_image_urls(urls):
+    """
+    Remember the Douban URL behind each image hash and return the proxied URLs.
+    """
+    hashes = [hashlib.blake2s(url.encode('utf-8'), digest_size=8).hexdigest() for url in urls]
+    db = get_db()
+    # Only write when something is new, so that serving a cached subject stays read-only
+    known = set(row['hash'] for row in db.execute(
+        'SELECT hash FROM image_url WHERE hash IN ({})'.format(','.join('?' * len(hashes))), hashes))
+    missing = [(h, url) for h, url in zip(hashes, urls) if h not in known]
+    if missing:
+        with db:
+            db.executemany('INSERT OR IGNORE INTO image_url (hash, url) VALUES (?, ?)', missing)
+    return ['{}/GetImage/{}'.format(WEBROOT, h) for h in hashes]
+
+
 def xmlify(root):
-    sio = io.StringIO()
-    ET.ElementTree(root).write(sio, xml_declaration=True, encoding='unicode')
-    xml = sio.getvalue()
-    if app.config['DEBUG']:
-        import xml.dom.minidom as minidom
-        reparsed = minidom.parseString(xml)
-        xml = reparsed.toprettyxml(indent='    ', encoding='utf-8')
+    xml = ET.tostring(root, xml_declaration=True, encoding='utf-8', pretty_print=app.config['DEBUG'] or request.args.get('pretty') == '1')
     return Response(xml, mimetype='text/xml')
 
 
@@ -165,66 +244,73 @@ def get_title_from_filename(filename):
     ('sense8', None, 0, 2)
     >>> get_title_from_filename('Billions.S03.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb')
     ('billions', None, 3, None)
+    >>> get_title_from_filename('Westworld.1080p.S02E03.mkv')
+    ('westworld', None, 2, 3)
+    >>> get_title_from_filename('Blade.Runner.2049.2017.1080p.BluRay.x264-SPARKS')
+    ('blade runner 2049', 2017, None, None)
+    >>> get_title_from_filename('Apollo.13.720p.BluRay.x264-SiNNERS')
+    ('apollo 13', None, None, None)
+    >>> get_title_from_filename('Foo.²⁰¹⁷.720p')
+    ('foo ²⁰¹⁷', None, None, None)
     """
     name = filename.lower().replace(' ', '.')
     season, episode = None, None
     end = len(name)
 
-    match = REGEX_SEASON_EPISODE.search(name)
-    if match:
-        season, _, episode = match.groups()
-        season = int(season)
-        if episode:
-            episode = int(episode)
+    for match in REGEX_TITLE_END.finditer(name):
         end = min(end, match.start())
-
-    for suffix in CLEAR_SUFFIX:
-        idx = name.find(suffix)
-        if idx != -1:
-            end = min(end, idx)
+        if match.group('season_episode'):
+            season = int(match.group('season'))
+            if match.group('episode'):
+                episode = int(match.group('episode'))
+            break
 
     split = name[:end].replace('.', ' ').strip().split()
     year = None
-    if len(split) > 1:
-        try:
-            year = int(split[-1])
-        except ValueError:
-            pass
-    if year is not None and 1900 <= year <= 2100:
-        split = split[:-1]
+    if len(split) > 1 and len(split[-1]) == 4 and split[-1].isdecimal():
+        year = int(split[-1])
+        if 1900 <= year <= 2100:
+            split = split[:-1]
+        else:
+            year = None
     title = ' '.join(split)
     return title, year, season, episode
 
 
 def replace_chinese_season_number(title):
-    for digit, chinese in enumerate(DIGITS_TO_CHINESE_NUMBER):
-        title = title.replace('第{}季'.format(chinese), '第{:02d}季'.format(digit))
-    return title
+    """
+    >>> replace_chinese_season_number('纸牌屋')
+    '纸牌屋'
+    >>> replace_chinese_season_number('纸牌屋 第二季')
+    '纸牌屋 第02季'
+    >>> replace_chinese_season_number('辛普森一家 第十一季')
+    '辛普森一家 第11季'
+    >>> replace_chinese_season_number('神探夏洛克 第十季')
+    '神探夏洛克 第10季'
+    """
+    return REGEX_CHINESE_SEASON.sub(lambda m: CHINESE_SEASON_TO_DIGITS[m.group(0)], title)
 
 
 @app.route('/GetSearchResults/<filename>')
 def GetSearchResults(filename):
     title, year, season, episode = get_title_from_filename(filename)
     print('(title, year, season, episode) =', repr((title, year, season, episode)))
-    value = cache_get('search:' + title, lambda: requests.get('https://api.douban.com/v2/movie/search', params=dict(q=title)))
+    value = cache_get('search:' + title, lambda: SESSION.get('https://api.douban.com/v2/movie/search', params=dict(q=title), timeout=HTTP_TIMEOUT))
     # pprint(value)
 
-    subjects = deque()
-    for subject in value['subjects']:
+    def year_matches(subject):
         try:
             subject_year = int(subject['year'])
         except:
-            subject_year = None
-        if not (subject_year is None or year is None or subject_year-1 <= year <= subject_year+1):
-            continue
-        prepend = False
-        if season is not None:
-            str_chinese_season = '第{}季'.format(DIGITS_TO_CHINESE_NUMBER[season])
-            prepend = str_chinese_season in subject['title']
-        if prepend:
-            subjects.appendleft(subject)
-        else:
-            subjects.append(subject)
+            return True
+        return year is None or subject_year-1 <= year <= subject_year+1
+
+    # Subjects naming the requested season go first; sort() is stable so Douban's order is kept otherwise
+    chinese_season = None
+    if season is not None and season < len(DIGITS_TO_CHINESE_NUMBER):
+        chinese_season = '第{}季'.format(DIGITS_TO_CHINESE_NUMBER[season])
+    subjects = [subject for subject in value['subjects'] if year_matches(subject)]
+    subjects.sort(key=lambda subject: 0 if chinese_season and chinese_season in subject['title'] else 1)
 
     root = ET.Element('results')
     root.attrib['sorted'] = 'yes'
@@ -240,7 +326,7 @@ def GetSearchResults(filename):
 
 @app.route('/GetDetails/<int:subject_id>')
 def GetDetails(subject_id):
-    value = cache_get('subject:{}'.format(subject_id), lambda: requests.get('https://api.douban.com/v2/movie/subject/{}'.format(subject_id)))
+    value = cache_get('subject:{}'.format(subject_id), lambda: SESSION.get('https://api.douban.com/v2/movie/subject/{}'.format(subject_id), timeout=HTTP_TIMEOUT))
 
     try:
         episode = int(request.args['episode'])
@@ -265,7 +351,7 @@ def GetDetails(subject_id):
         for director in value['directors']:
             ET.SubElement(root, 'director').text = director.get('name', '')
     if episode is None and 'images' in value and 'large' in value['images']:
-        ET.SubElement(root, 'thumb').text = '{}/GetImage?url={}'.format(WEBROOT, quote_plus(value['images']['large']))
+        ET.SubElement(root, 'thumb').text = value['images']['large']
     if 'genres' in value:
         for genre in value['genres']:
             ET.SubElement(root, 'genre').text = genre
@@ -274,30 +360,86 @@ def GetDetails(subject_id):
             actor = ET.SubElement(root, 'actor')
             ET.SubElement(actor, 'name').text = cast['name']
             if 'avatars' in cast and 'large' in cast['avatars']:
-                ET.SubElement(actor, 'thumb').text = '{}/GetImage?url={}'.format(WEBROOT, quote_plus(cast['avatars']['large']))
+                ET.SubElement(actor, 'thumb').text = cast['avatars']['large']
     if 'countries' in value:
         for country in value['countries']:
             ET.SubElement(root, 'country').text = country
 
+    # Point every thumb at the local image proxy
+    thumbs = root.findall('.//thumb')
+    urls = [thumb.text for thumb in thumbs]
+    for thumb, proxied_url in zip(thumbs, register_image_urls(urls)):
+        thumb.text = proxied_url
+    # Warm the image cache in the background so the thumbs are ready when Kodi asks for them
+    for url in OrderedDict.fromkeys(urls):
+        if url not in _prefetching and not image_is_cached(url):
+            gevent.spawn(prefetch_image, url)
+
     return xmlify(root)
 
 
+def send_image(url):
+    print('GetImage', url)
+    # Wait for a prefetch that is already downloading this image instead of downloading it twice
+    prefetch = _prefetching.get(url)
+    if prefetch is not None:
+        prefetch.join()
+    path = cache_get('image:'+url, lambda: SESSION.get(url, timeout=HTTP_TIMEOUT), type='file')
+    # Image files are named by content hash, which makes a natural strong ETag
+    digest = os.path.basename(path)
+    if digest in request.if_none_match:
+        response = Response(status=304, mimetype='image/jpeg')
+    else:
+        response = send_file(path, mimetype='image/jpeg', as_attachment=False, add_etags=False)
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/GetImage/<image_hash>')
+def GetImageByHash(image_hash):
+    row = get_db().execute('SELECT url FROM image_url WHERE hash=?', (image_hash, )).fetchone()
+    if row is None:
+        # Only image_url in cache.db maps a hash back to its Douban URL. If cache.db was deleted,
+        # this stays a 404 until the title is scraped again, which records the hash anew.
+        abort(404)
+    return send_image(row['url'])
+
+
+# Limits concurrent image downloads started by GetDetails across all requests
+_prefetch_semaphore = BoundedSemaphore(PREFETCH_CONCURRENCY)
+# Greenlets currently downloading an image, keyed by URL. Queued prefetches are not listed,
+# so a GetImage request never waits behind the semaphore.
+_prefetching = {}
+
+def image_is_cached(url):
+    row = get_db().execute('SELECT value FROM cache WHERE key=?', ('image:'+url, )).fetchone()
+    return row is not None and os.path.exists(os.path.join(IMAGE_DIR, row['value']))
+
+
+def prefetch_image(url):
+    # Prefetches are not counted in stats: they are not queries made by Kodi
+    with _prefetch_semaphore:
+        _prefetching[url] = gevent.getcurrent()
+        try:
+            cache_get('image:'+url, lambda: SESSION.get(url, timeout=HTTP_TIMEOUT), type='file', stats=False)
+        except (requests.RequestException, sqlite3.Error, OSError) as e:
+            print('prefetch_image', url, e)
+        finally:
+            del _prefetching[url]
+
+
+# Kept for thumbs that Kodi saved before images were addressed by hash
 @app.route('/GetImage')
 def GetImage():
-    url = request.args['url']
-    print('GetImage', url)
-    content = cache_get('image:'+url, lambda: requests.get(url), type='bytes')
-    return send_file(io.BytesIO(content), mimetype='image/jpeg', as_attachment=False)
+    return send_image(request.args['url'])
 
 
 
 if __name__ == '__main__':
-    if app.config['DEBUG']:
-        app.run(port=WEB_PORT)
-    else:
-        http_server = WSGIServer(('127.0.0.1', WEB_PORT), app)
-        try:
-            print('WSGIServer start')
-            http_server.serve_forever()
-        except KeyboardInterrupt:
-            print('WSGIServer stopped')
+    http_server = WSGIServer(('127.0.0.1', WEB_PORT), app)
+    try:
+        print('WSGIServer start')
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        print('WSGIServer stopped')